@@ -5,7 +5,8 @@ nata - not another todo app
 """
 
 import webbrowser
-from flask import Flask, request, jsonify, render_template, send_file
+from flask import Flask, request, jsonify, render_template, send_file, g, has_app_context
+from flask.json.provider import DefaultJSONProvider
 import sqlite3
 import os
 import socket
@@ -22,19 +23,29 @@ from collections import deque
 import json
 import yaml
 import tempfile
+import time
+import cProfile
+import pstats
+import io
+from contextlib import contextmanager, nullcontext
+from collections.abc import Mapping
+import itertools
 
 # 创建一个循环缓冲区来存储最近的日志
 class LogBuffer:
     def __init__(self, maxlen=100):
         self.buffer = deque(maxlen=maxlen)
     
-    def add_log(self, level, message):
+    def add_log(self, level, message, details=None):
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         log_entry = {
             'timestamp': timestamp,
             'level': level,
             'message': message
         }
+        # 性能分析等附加信息（可选）
+        if details is not None:
+            log_entry['details'] = details
         self.buffer.append(log_entry)
     
     def get_logs(self):
@@ -52,6 +63,15 @@ class BufferHandler(logging.Handler):
 # 默认配置
 DEFAULT_DB_PATH = 'todos.db'
 DEFAULT_PORT = 12345
+# 性能分析报告中保留的cProfile函数条数
+PROFILE_TOP_N = 25
+# 开启单次请求性能分析的请求头和查询参数
+PROFILE_HEADER = 'X-Nata-Profile'
+PROFILE_QUERY_ARG = 'profile'
+# 性能分析报告编号，供调试面板区分每份报告
+profile_ids = itertools.count(1)
+# 性能分析钩子是否已安装；未安装时所有分析相关的检查都直接跳过
+profiling_installed = False
 
 def get_db_path():
     """
@@ -85,6 +105,18 @@ def get_port():
 # 定义初始端口号
 PORT = get_port()
 
+# 性能分析开关函数
+def is_profiling_enabled():
+    """
+    是否允许按请求开启性能分析，优先级：
+    1. 命令行参数 --enable-profiling
+    2. 环境变量 NATA_ENABLE_PROFILING (1/true/yes)
+    3. 默认关闭
+    """
+    if hasattr(app, 'enable_profiling'):
+        return app.enable_profiling
+    return os.getenv('NATA_ENABLE_PROFILING', '').lower() in ('1', 'true', 'yes')
+
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -95,6 +127,202 @@ buffer_handler.setFormatter(formatter)
 logger.addHandler(buffer_handler)
 app.logger.addHandler(buffer_handler)
 
+# 获取当前请求的性能分析上下文
+def get_request_profile():
+    """
+    返回当前请求的性能分析数据，未开启性能分析时返回None
+    """
+    if not profiling_installed or not has_app_context():
+        return None
+    return g.get('profile')
+
+# 未开启性能分析时共用的空上下文管理器
+NULL_SECTION = nullcontext()
+
+# 统计代码片段耗时
+def profile_section(name):
+    """
+    记录代码片段（如JSON/YAML序列化、二维码生成）的耗时
+    未开启性能分析时返回空上下文管理器，不做任何计时
+    """
+    profile = get_request_profile()
+    if profile is None:
+        return NULL_SECTION
+    return _timed_section(profile, name)
+
+@contextmanager
+def _timed_section(profile, name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        section = profile['sections'].setdefault(name, {'count': 0, 'total_ms': 0.0})
+        section['count'] += 1
+        section['total_ms'] += elapsed_ms
+
+# 记录SQL语句耗时的游标
+class ProfilingCursor(sqlite3.Cursor):
+    # 最近一次execute的记录，fetch耗时累加到该记录上
+    query = None
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            self.query = self.connection.record_query(sql, parameters, elapsed_ms)
+
+    def _timed_fetch(self, fetch, *args):
+        # SELECT在execute时只取到第一行，其余的工作发生在fetch中
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            if self.query is not None:
+                self.query['ms'] += (time.perf_counter() - start) * 1000
+
+    def fetchone(self):
+        return self._timed_fetch(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self._timed_fetch(super().fetchmany, *args)
+
+    def fetchall(self):
+        return self._timed_fetch(super().fetchall)
+
+# 记录SQL语句及其查询计划的数据库连接
+class ProfilingConnection(sqlite3.Connection):
+    # 只有这些语句支持 EXPLAIN QUERY PLAN
+    EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def record_query(self, sql, parameters, elapsed_ms):
+        if isinstance(parameters, Mapping):
+            params = {key: str(value) for key, value in parameters.items()}
+        else:
+            params = [str(param) for param in parameters]
+        query = {
+            'sql': ' '.join(sql.split()),
+            'params': params,
+            'ms': elapsed_ms,
+            'plan': None
+        }
+        if query['sql'].upper().startswith(self.EXPLAINABLE):
+            try:
+                # 使用基类的execute，避免查询计划本身被记录
+                rows = sqlite3.Connection.execute(self, 'EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+                query['plan'] = [row[3] for row in rows]
+            except sqlite3.Error as e:
+                query['plan'] = [f'EXPLAIN 失败: {e}']
+        self.profile['queries'].append(query)
+        return query
+
+# 获取数据库连接
+def get_db_connection():
+    """
+    打开数据库连接
+    当前请求开启了性能分析时，返回会记录SQL耗时和查询计划的连接
+    """
+    profile = get_request_profile()
+    if profile is None:
+        return sqlite3.connect(get_db_path())
+    conn = sqlite3.connect(get_db_path(), factory=ProfilingConnection)
+    conn.profile = profile
+    return conn
+
+# 统计JSON序列化耗时的JSON提供器
+class ProfilingJSONProvider(DefaultJSONProvider):
+    def dumps(self, obj, **kwargs):
+        with profile_section('json'):
+            return super().dumps(obj, **kwargs)
+
+# 请求开始时按需开启性能分析
+def start_request_profile():
+    """
+    请求带有 X-Nata-Profile 请求头或 profile 查询参数时，
+    为本次请求开启cProfile并收集SQL与序列化耗时
+    """
+    flag = request.headers.get(PROFILE_HEADER) or request.args.get(PROFILE_QUERY_ARG)
+    if not flag or flag.lower() in ('0', 'false', 'no'):
+        return
+
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # 同一时间只能有一个cProfile在运行（例如并发的另一请求正在分析）
+        app.logger.warning(f"性能分析未启用cProfile: 已有分析器在运行 ({request.path})")
+        profiler = None
+    g.profile = {
+        'profiler': profiler,
+        'start': time.perf_counter(),
+        'queries': [],
+        'sections': {}
+    }
+
+# 请求结束时输出性能分析报告
+def finish_request_profile(exc):
+    """
+    停止性能分析，并将报告写入日志缓冲区供调试面板查看
+    """
+    profile = g.pop('profile', None)
+    if profile is None:
+        return
+    profiler = profile['profiler']
+    if profiler is not None:
+        profiler.disable()
+    total_ms = (time.perf_counter() - profile['start']) * 1000
+
+    cprofile_summary = None
+    if profiler is not None:
+        stream = io.StringIO()
+        stats = pstats.Stats(profiler, stream=stream)
+        stats.sort_stats('cumulative').print_stats(PROFILE_TOP_N)
+        cprofile_summary = stream.getvalue()
+
+    queries = [dict(query, ms=round(query['ms'], 3)) for query in profile['queries']]
+    sections = {
+        name: {'count': section['count'], 'total_ms': round(section['total_ms'], 3)}
+        for name, section in profile['sections'].items()
+    }
+    sql_ms = sum(query['ms'] for query in queries)
+    message = (f"性能分析 {request.method} {request.full_path.rstrip('?')}: "
+               f"总耗时 {total_ms:.1f} ms, SQL {len(queries)} 条 ({sql_ms:.1f} ms)")
+    if exc is not None:
+        message += f", 请求异常: {exc}"
+    log_buffer.add_log('PROFILE', message, {
+        'id': next(profile_ids),
+        'total_ms': round(total_ms, 3),
+        'queries': queries,
+        'sections': sections,
+        'cprofile': cprofile_summary
+    })
+
+# 安装性能分析钩子
+def install_request_profiling():
+    """
+    安装统计JSON序列化耗时的JSON提供器，并注册请求开始/结束钩子
+    仅在配置允许性能分析时调用，未开启时请求处理路径上没有任何额外开销
+    """
+    global profiling_installed
+    if profiling_installed:
+        return
+    app.json = ProfilingJSONProvider(app)
+    app.before_request(start_request_profile)
+    app.teardown_request(finish_request_profile)
+    profiling_installed = True
+
+# 通过环境变量开启时，在启动阶段安装性能分析钩子
+if is_profiling_enabled():
+    install_request_profiling()
+
 # 获取本机内网IP地址
 def get_local_ip():
     """
@@ -215,7 +443,8 @@ def get_network_info():
     # 构造完整的访问URL
     url = f"http://{local_ip}:{port}"
     # 生成二维码
-    qr_code = generate_qr_code(url)
+    with profile_section('qrcode'):
+        qr_code = generate_qr_code(url)
     
     # 返回JSON格式的网络信息
     return jsonify({
@@ -234,7 +463,7 @@ def get_tasks():
     """
     app.logger.info("获取所有任务列表")
     
-    conn = sqlite3.connect(get_db_path())
+    conn = get_db_connection()
     conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
     # 查询所有任务，按到期时间排序（NULL值排在最后）
@@ -276,7 +505,7 @@ def add_task():
         return jsonify({'error': '任务标题不能为空'}), 400
     
     # 插入新任务到数据库
-    conn = sqlite3.connect(get_db_path())
+    conn = get_db_connection()
     cursor = conn.cursor()
     # 插入新任务的SQL语句
     insert_query = '''
@@ -309,7 +538,7 @@ def delete_task(task_id):
     
     conn = None
     try:
-        conn = sqlite3.connect(get_db_path())
+        conn = get_db_connection()
         cursor = conn.cursor()
         # 检查任务是否存在
         cursor.execute('SELECT id FROM tasks WHERE id = ?', (task_id,))
@@ -349,7 +578,7 @@ def toggle_task(task_id):
     
     conn = None
     try:
-        conn = sqlite3.connect(get_db_path())
+        conn = get_db_connection()
         cursor = conn.cursor()
         # 查询指定ID任务当前状态的SQL语句
         select_query = '''
@@ -413,7 +642,7 @@ def batch_delete_tasks():
     
     conn = None
     try:
-        conn = sqlite3.connect(get_db_path())
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         # 检查任务是否存在
@@ -459,7 +688,7 @@ def export_tasks():
     
     conn = None
     try:
-        conn = sqlite3.connect(get_db_path())
+        conn = get_db_connection()
         conn.row_factory = sqlite3.Row
         cursor = conn.cursor()
         
@@ -497,7 +726,8 @@ def export_tasks():
             export_data['tasks'].append(task_data)
         
         # 生成YAML内容
-        yaml_content = yaml.dump(export_data, default_flow_style=False, allow_unicode=True, sort_keys=False)
+        with profile_section('yaml'):
+            yaml_content = yaml.dump(export_data, default_flow_style=False, allow_unicode=True, sort_keys=False)
         
         # 创建临时文件
         temp_file = tempfile.NamedTemporaryFile(mode='w', suffix='.yaml', delete=False, encoding='utf-8')
@@ -549,7 +779,8 @@ def import_tasks():
         
         # 解析YAML
         try:
-            import_data = yaml.safe_load(file_content)
+            with profile_section('yaml'):
+                import_data = yaml.safe_load(file_content)
         except yaml.YAMLError as e:
             app.logger.error(f"YAML解析失败: {str(e)}")
             return jsonify({'error': 'YAML文件格式错误: ' + str(e)}), 400
@@ -565,7 +796,7 @@ def import_tasks():
             return jsonify({'error': 'tasks字段必须是列表'}), 400
         
         # 导入任务
-        conn = sqlite3.connect(get_db_path())
+        conn = get_db_connection()
         cursor = conn.cursor()
         
         imported_count = 0
@@ -631,6 +862,9 @@ if __name__ == '__main__':
     parser.add_argument('--port',
                       type=int,
                       help='服务器端口 (默认: 12345，可通过环境变量 NATA_PORT 设置)')
+    parser.add_argument('--enable-profiling',
+                      action='store_true',
+                      help='允许通过 X-Nata-Profile 请求头或 ?profile=1 对单次请求进行性能分析 (可通过环境变量 NATA_ENABLE_PROFILING 设置)')
     args = parser.parse_args()
     
     # 如果指定了数据库路径，设置到应用配置中
@@ -641,6 +875,10 @@ if __name__ == '__main__':
     if args.port:
         app.port = args.port
     
+    # 如果指定了开启性能分析，设置到应用配置中
+    if args.enable_profiling:
+        app.enable_profiling = True
+    
     # 获取最终使用的端口
     port = get_port()
     
@@ -653,6 +891,9 @@ if __name__ == '__main__':
     # 记录配置信息
     app.logger.info(f"使用数据库: {get_db_path()}")
     app.logger.info(f"监听端口: {port}")
+    if is_profiling_enabled():
+        install_request_profiling()
+        app.logger.info(f"已允许按请求性能分析 (请求头 {PROFILE_HEADER}: 1 或查询参数 ?{PROFILE_QUERY_ARG}=1)")
     
     # 启动应用（禁用调试模式避免重启问题）
     # 在新线程中启动浏览器，避免阻塞应用启动